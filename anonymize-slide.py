@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 #
 #  anonymize-slide.py - Delete the label from a whole-slide image.
 #
@@ -22,13 +22,15 @@
 #  Boston, MA 02110-1301 USA.
 #
 
-from __future__ import division
-from ConfigParser import RawConfigParser
-from cStringIO import StringIO
+import array
+from configparser import RawConfigParser
+import ctypes
 from glob import glob
+import io
+import mmap
 from optparse import OptionParser
 import os
-import string
+import re
 import struct
 import sys
 
@@ -39,6 +41,7 @@ PROG_VERSION = '1.1.1'
 DEBUG = False
 
 # TIFF types
+BYTE = 1
 ASCII = 2
 SHORT = 3
 LONG = 4
@@ -46,6 +49,18 @@ FLOAT = 11
 DOUBLE = 12
 LONG8 = 16
 
+# TIFF type -> array typecode for numeric arrays.  Assumes the usual C
+# type sizes.
+TYPE_TYPECODES = {
+    BYTE: 'B',
+    SHORT: 'H',
+    LONG: 'I',
+    FLOAT: 'f',
+    DOUBLE: 'd',
+    LONG8: 'Q',
+}
+NATIVE_PREFIX = '<' if sys.byteorder == 'little' else '>'
+
 # TIFF tags
 IMAGE_DESCRIPTION = 270
 STRIP_OFFSETS = 273
@@ -54,28 +69,108 @@ NDPI_MAGIC = 65420
 NDPI_SOURCELENS = 65421
 
 # Format headers
-LZW_CLEARCODE = '\x80'
-JPEG_SOI = '\xff\xd8'
-UTF8_BOM = '\xef\xbb\xbf'
+LZW_CLEARCODE = b'\x80'
+JPEG_SOI = b'\xff\xd8'
+UTF8_BOM = b'\xef\xbb\xbf'
+
+# Write zeroes from a single reusable buffer rather than allocating a
+# buffer the size of each image strip
+ZERO_CHUNK = b'\0' * (1 << 20)
+
+# Readahead hint; not available on Windows
+_fadvise = getattr(os, 'posix_fadvise', None)
+
+# Positional IO; not available on Windows
+_pread = getattr(os, 'pread', None)
+_pwrite = getattr(os, 'pwrite', None)
+
+# Vectored writes; not available on Windows or before Python 3.7
+_pwritev = getattr(os, 'pwritev', None)
+ZERO_VIEW = memoryview(ZERO_CHUNK)
+IOV_MAX = 1024
+
+# Hole punching; Linux-only, and not exposed by the os module
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+try:
+    _fallocate = ctypes.CDLL('libc.so.6', use_errno=True).fallocate
+    _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_longlong,
+            ctypes.c_longlong)
+except (OSError, AttributeError):
+    _fallocate = None
+
+
+def _punch_hole(fd, offset, length):
+    # Deallocate the range so the filesystem reads it back as zeroes,
+    # without writing any data.  Returns False if unsupported (e.g.
+    # non-Linux, or a filesystem without hole support), in which case
+    # the caller must zero the range itself.
+    if _fallocate is None:
+        return False
+    return _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+            offset, length) == 0
+
+
+def _zero_file_range(fh, offset, length):
+    # Zero a range of a plain binary file, punching a hole when possible
+    # and otherwise writing from the shared bounded buffer
+    if _punch_hole(fh.fileno(), offset, length):
+        return
+    fh.seek(offset)
+    remaining = length
+    while remaining:
+        count = min(remaining, len(ZERO_CHUNK))
+        fh.write(ZERO_CHUNK[:count])
+        remaining -= count
+
+# Format string conversion tables.  Format strings can have special
+# characters:
+# y: 16-bit   signed on little TIFF, 64-bit   signed on BigTIFF
+# Y: 16-bit unsigned on little TIFF, 64-bit unsigned on BigTIFF
+# z: 32-bit   signed on little TIFF, 64-bit   signed on BigTIFF
+# Z: 32-bit unsigned on little TIFF, 64-bit unsigned on BigTIFF
+# D: 32-bit unsigned on little TIFF, 64-bit unsigned on BigTIFF/NDPI
+FMT_MAP_BIGTIFF = str.maketrans('yYzZD', 'qQqQQ')
+FMT_MAP_NDPI = str.maketrans('yYzZD', 'hHiIQ')
+FMT_MAP_TIFF = str.maketrans('yYzZD', 'hHiII')
+
+# Directory entry ('HHZZ') parsers, precompiled for every combination of
+# endianness and TIFF version.  NDPI mode only changes pointer widths, not
+# the entry layout, so it needs no key of its own.
+ENTRY_STRUCTS = dict(((prefix, bigtiff),
+        struct.Struct(prefix + ('HHQQ' if bigtiff else 'HHII')))
+        for prefix in '<>' for bigtiff in (False, True))
 
 # MRXS
 MRXS_HIERARCHICAL = 'HIERARCHICAL'
 MRXS_NONHIER_ROOT_OFFSET = 41
+MRXS_NONHIER_VAL_KEY = re.compile(r'(NONHIER_\d+_VAL_\d+)(?=_|$)')
+MRXS_INT32 = struct.Struct('<i')
 
 
 class UnrecognizedFile(Exception):
     pass
 
 
-class TiffFile(file):
+class TiffFile(object):
     def __init__(self, path):
-        file.__init__(self, path, 'r+b')
+        self.file = open(path, 'r+b')
+
+        # Map the file so the many small reads during directory parsing
+        # become memory accesses rather than buffered IO calls.  Fall
+        # back to ordinary file IO if the file can't be mapped (e.g. it
+        # doesn't fit in the address space on 32-bit builds).
+        self._mm = None
+        try:
+            self._mm = mmap.mmap(self.file.fileno(), 0)
+        except (OSError, OverflowError, ValueError):
+            pass
 
         # Check header, decide endianness
         endian = self.read(2)
-        if endian == 'II':
+        if endian == b'II':
             self._fmt_prefix = '<'
-        elif endian == 'MM':
+        elif endian == b'MM':
             self._fmt_prefix = '>'
         else:
             raise UnrecognizedFile
@@ -83,6 +178,8 @@ class TiffFile(file):
         # Check TIFF version
         self._bigtiff = False
         self._ndpi = False
+        self._fmt_cache = {}
+        self._struct_cache = {}
         version = self.read_fmt('H')
         if version == 42:
             pass
@@ -94,45 +191,163 @@ class TiffFile(file):
         else:
             raise UnrecognizedFile
 
-        # Read directories
-        self.directories = []
+        # Pick the precompiled directory entry parser
+        self._entry_struct = ENTRY_STRUCTS[(self._fmt_prefix, self._bigtiff)]
+
+        # Walk the directory chain, parsing only the first directory up
+        # front: NDPI detection needs its entries and changes the width of
+        # every later pointer.  The rest are just skipped over here and
+        # parsed on first access.
+        offsets = []
+        first_directory = None
         while True:
             in_pointer_offset = self.tell()
             directory_offset = self.read_fmt('D')
             if directory_offset == 0:
                 break
             self.seek(directory_offset)
-            directory = TiffDirectory(self, len(self.directories),
-                    in_pointer_offset)
-            if not self.directories and not self._bigtiff:
-                # Check for NDPI.  Because we don't know we have an NDPI file
-                # until after reading the first directory, we will choke if
-                # the first directory is beyond 4 GB.
-                if NDPI_MAGIC in directory.entries:
-                    if DEBUG:
-                        print 'Enabling NDPI mode.'
-                    self._ndpi = True
-            self.directories.append(directory)
-        if not self.directories:
+            if not offsets:
+                first_directory = TiffDirectory(self, 0, in_pointer_offset)
+                if not self._bigtiff:
+                    # Check for NDPI.  Because we don't know we have an NDPI
+                    # file until after reading the first directory, we will
+                    # choke if the first directory is beyond 4 GB.
+                    if NDPI_MAGIC in first_directory.entries:
+                        if DEBUG:
+                            print('Enabling NDPI mode.')
+                        self._ndpi = True
+                        self._fmt_cache.clear()
+                        self._struct_cache.clear()
+            else:
+                # Seek past the entry table to the out-pointer
+                count = self.read_fmt('Y')
+                self.seek(count * self._entry_struct.size, 1)
+            offsets.append((in_pointer_offset, directory_offset))
+        if not offsets:
             raise IOError('No directories')
+        self.directories = LazyDirectoryList(self, offsets, first_directory)
 
-    def _convert_format(self, fmt):
-        # Format strings can have special characters:
-        # y: 16-bit   signed on little TIFF, 64-bit   signed on BigTIFF
-        # Y: 16-bit unsigned on little TIFF, 64-bit unsigned on BigTIFF
-        # z: 32-bit   signed on little TIFF, 64-bit   signed on BigTIFF
-        # Z: 32-bit unsigned on little TIFF, 64-bit unsigned on BigTIFF
-        # D: 32-bit unsigned on little TIFF, 64-bit unsigned on BigTIFF/NDPI
-        if self._bigtiff:
-            fmt = fmt.translate(string.maketrans('yYzZD', 'qQqQQ'))
-        elif self._ndpi:
-            fmt = fmt.translate(string.maketrans('yYzZD', 'hHiIQ'))
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size):
+        if self._mm is not None:
+            return self._mm.read(size)
+        return self.file.read(size)
+
+    def write(self, buf):
+        if self._mm is not None:
+            self._mm.write(buf)
+        else:
+            self.file.write(buf)
+
+    def seek(self, offset, whence=0):
+        if self._mm is not None:
+            self._mm.seek(offset, whence)
+        else:
+            self.file.seek(offset, whence)
+
+    def tell(self):
+        if self._mm is not None:
+            return self._mm.tell()
+        return self.file.tell()
+
+    def pread(self, size, offset):
+        # Positional read; doesn't disturb the file position
+        if self._mm is not None:
+            return self._mm[offset:offset + size]
+        if _pread is not None:
+            return _pread(self.file.fileno(), size, offset)
+        self.seek(offset)
+        return self.read(size)
+
+    def pwrite(self, buf, offset):
+        # Positional write; doesn't disturb the file position
+        if self._mm is not None:
+            self._mm[offset:offset + len(buf)] = buf
+        elif _pwrite is not None:
+            _pwrite(self.file.fileno(), buf, offset)
+        else:
+            self.seek(offset)
+            self.write(buf)
+
+    def zero_range(self, offset, length):
+        # Punch a hole if the filesystem supports it; otherwise write
+        # zeroes from the shared bounded buffer, batched into as few
+        # syscalls as the platform allows
+        if _punch_hole(self.fileno(), offset, length):
+            return
+        end = offset + length
+        if self._mm is not None:
+            while offset < end:
+                count = min(end - offset, len(ZERO_CHUNK))
+                self._mm[offset:offset + count] = ZERO_CHUNK[:count]
+                offset += count
+        elif _pwritev is not None:
+            while offset < end:
+                iovs = []
+                pos = offset
+                while pos < end and len(iovs) < IOV_MAX:
+                    count = min(end - pos, len(ZERO_CHUNK))
+                    iovs.append(ZERO_VIEW[:count])
+                    pos += count
+                written = _pwritev(self.fileno(), iovs, offset)
+                if written <= 0:
+                    raise IOError('Short write')
+                offset += written
+        else:
+            while offset < end:
+                count = min(end - offset, len(ZERO_CHUNK))
+                self.pwrite(ZERO_CHUNK[:count], offset)
+                offset += count
+
+    def truncate(self, size):
+        if self._mm is not None:
+            # resizes both the mapping and the underlying file
+            self._mm.resize(size)
         else:
-            fmt = fmt.translate(string.maketrans('yYzZD', 'hHiII'))
-        return self._fmt_prefix + fmt
+            self.file.truncate(size)
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm.close()
+            self._mm = None
+        self.file.close()
+
+    def _convert_format(self, fmt):
+        # The cache is invalidated when NDPI mode is enabled
+        try:
+            return self._fmt_cache[fmt]
+        except KeyError:
+            if self._bigtiff:
+                table = FMT_MAP_BIGTIFF
+            elif self._ndpi:
+                table = FMT_MAP_NDPI
+            else:
+                table = FMT_MAP_TIFF
+            converted = self._fmt_prefix + fmt.translate(table)
+            self._fmt_cache[fmt] = converted
+            return converted
+
+    def _get_struct(self, fmt):
+        # The cache is invalidated when NDPI mode is enabled
+        try:
+            return self._struct_cache[fmt]
+        except KeyError:
+            st = struct.Struct(self._convert_format(fmt))
+            self._struct_cache[fmt] = st
+            return st
 
     def fmt_size(self, fmt):
-        return struct.calcsize(self._convert_format(fmt))
+        return self._get_struct(fmt).size
 
     def near_pointer(self, base, offset):
         # If NDPI, return the value whose low-order 32-bits are equal to
@@ -143,28 +358,96 @@ class TiffFile(file):
             offset += ((base - offset) // seg_size) * seg_size
         return offset
 
+    def near_pointers(self, base, offsets):
+        # Batch version of near_pointer.  The adjustment stays per
+        # offset, since strips straddling a 4 GB boundary need different
+        # shifts, but non-NDPI files skip the loop entirely.
+        if not self._ndpi:
+            return offsets
+        seg_size = 1 << 32
+        return [offset + ((base - offset) // seg_size) * seg_size
+                if offset < base else offset
+                for offset in offsets]
+
     def read_fmt(self, fmt, force_list=False):
-        fmt = self._convert_format(fmt)
-        vals = struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+        st = self._get_struct(fmt)
+        vals = st.unpack(self.read(st.size))
         if len(vals) == 1 and not force_list:
             return vals[0]
         else:
             return vals
 
     def write_fmt(self, fmt, *args):
-        fmt = self._convert_format(fmt)
-        self.write(struct.pack(fmt, *args))
+        self.write(self._get_struct(fmt).pack(*args))
+
+    def pread_fmt(self, fmt, offset):
+        st = self._get_struct(fmt)
+        vals = st.unpack(self.pread(st.size, offset))
+        if len(vals) == 1:
+            return vals[0]
+        else:
+            return vals
+
+    def pwrite_fmt(self, fmt, offset, *args):
+        self.pwrite(self._get_struct(fmt).pack(*args), offset)
+
+
+class LazyDirectoryList(object):
+    # List-like view of a TIFF directory chain that parses each entry
+    # table on first access
+    def __init__(self, fh, offsets, first_directory):
+        self._fh = fh
+        self._offsets = offsets
+        self._cache = [first_directory] + [None] * (len(offsets) - 1)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, number):
+        if number < 0:
+            number += len(self._offsets)
+        if not 0 <= number < len(self._offsets):
+            raise IndexError('No such directory')
+        directory = self._cache[number]
+        if directory is None:
+            in_pointer_offset, directory_offset = self._offsets[number]
+            self._fh.seek(directory_offset)
+            directory = TiffDirectory(self._fh, number, in_pointer_offset)
+            self._cache[number] = directory
+        return directory
+
+    def __iter__(self):
+        for number in range(len(self._offsets)):
+            yield self[number]
 
 
 class TiffDirectory(object):
     def __init__(self, fh, number, in_pointer_offset):
         self.entries = {}
         count = fh.read_fmt('Y')
-        for _ in range(count):
-            entry = TiffEntry(fh)
+        # Read the whole entry table at once and parse it in memory,
+        # rather than issuing a small read per entry
+        entry_struct = fh._entry_struct
+        start = fh.tell()
+        if _fadvise is not None:
+            # Hint the kernel to read the entry table and trailing
+            # pointer ahead of the parse; out-of-line entry values
+            # usually sit nearby and benefit from the same readahead
+            try:
+                _fadvise(fh.fileno(), start,
+                        count * entry_struct.size + fh.fmt_size('D'),
+                        os.POSIX_FADV_WILLNEED)
+            except OSError:
+                pass
+        buf = fh.read(count * entry_struct.size)
+        if len(buf) != count * entry_struct.size:
+            raise IOError('Short read')
+        for i in range(count):
+            entry = TiffEntry(fh, start + i * entry_struct.size,
+                    entry_struct.unpack_from(buf, i * entry_struct.size))
             self.entries[entry.tag] = entry
         self._in_pointer_offset = in_pointer_offset
-        self._out_pointer_offset = fh.tell()
+        self._out_pointer_offset = start + count * entry_struct.size
         self._fh = fh
         self._number = number
 
@@ -176,66 +459,100 @@ class TiffDirectory(object):
         except KeyError:
             raise IOError('Directory is not stripped')
 
-        # Wipe strips
-        for offset, length in zip(offsets, lengths):
-            offset = self._fh.near_pointer(self._out_pointer_offset, offset)
-            if DEBUG:
-                print 'Zeroing', offset, 'for', length
-            self._fh.seek(offset)
-            if expected_prefix:
-                buf = self._fh.read(len(expected_prefix))
+        # Check all strips before modifying anything
+        offsets = self._fh.near_pointers(self._out_pointer_offset, offsets)
+        strips = list(zip(offsets, lengths))
+        if expected_prefix:
+            for offset, _length in strips:
+                buf = self._fh.pread(len(expected_prefix), offset)
                 if buf != expected_prefix:
                     raise IOError('Unexpected data in image strip')
-                self._fh.seek(offset)
-            self._fh.write('\0' * length)
+
+        # Read successor pointer before wiping anything, since the
+        # truncate path below may remove this directory from the file
+        out_pointer = self._fh.pread_fmt('D', self._out_pointer_offset)
+
+        # Merge adjacent strips into ranges
+        strips.sort()
+        ranges = []
+        for offset, length in strips:
+            if ranges and offset <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], offset + length)
+            else:
+                ranges.append([offset, offset + length])
+
+        # If the last range runs to EOF, drop it by truncating the file
+        # rather than writing zeroes
+        truncate_to = None
+        if ranges:
+            file_size = os.fstat(self._fh.fileno()).st_size
+            if ranges[-1][1] == file_size:
+                truncate_to = ranges.pop()[0]
+
+        # Wipe remaining ranges
+        for start, end in ranges:
+            if DEBUG:
+                print('Zeroing', start, 'for', end - start)
+            self._fh.zero_range(start, end - start)
 
         # Remove directory
         if DEBUG:
-            print 'Deleting directory', self._number
-        self._fh.seek(self._out_pointer_offset)
-        out_pointer = self._fh.read_fmt('D')
-        self._fh.seek(self._in_pointer_offset)
-        self._fh.write_fmt('D', out_pointer)
+            print('Deleting directory', self._number)
+        self._fh.pwrite_fmt('D', self._in_pointer_offset, out_pointer)
+
+        # Truncate away the tail range
+        if truncate_to is not None:
+            if DEBUG:
+                print('Truncating to', truncate_to)
+            self._fh.truncate(truncate_to)
 
 
 class TiffEntry(object):
-    def __init__(self, fh):
-        self.start = fh.tell()
-        self.tag, self.type, self.count, self.value_offset = \
-                fh.read_fmt('HHZZ')
+    def __init__(self, fh, start, fields):
+        self.start = start
+        self.tag, self.type, self.count, self.value_offset = fields
         self._fh = fh
 
     def value(self):
         if self.type == ASCII:
-            item_fmt = 'c'
-        elif self.type == SHORT:
-            item_fmt = 'H'
-        elif self.type == LONG:
-            item_fmt = 'I'
-        elif self.type == LONG8:
-            item_fmt = 'Q'
-        elif self.type == FLOAT:
-            item_fmt = 'f'
-        elif self.type == DOUBLE:
-            item_fmt = 'd'
+            return self._value_ascii()
         else:
-            raise ValueError('Unsupported type')
+            return self._value_numeric()
 
-        fmt = '%d%s' % (self.count, item_fmt)
-        len = self._fh.fmt_size(fmt)
-        if len <= self._fh.fmt_size('Z'):
+    def _seek_value(self, size):
+        if size <= self._fh.fmt_size('Z'):
             # Inline value
             self._fh.seek(self.start + self._fh.fmt_size('HHZ'))
         else:
             # Out-of-line value
             self._fh.seek(self._fh.near_pointer(self.start, self.value_offset))
-        items = self._fh.read_fmt(fmt, force_list=True)
-        if self.type == ASCII:
-            if items[-1] != '\0':
-                raise ValueError('String not null-terminated')
-            return ''.join(items[:-1])
-        else:
-            return items
+
+    def _value_ascii(self):
+        # A single raw read rather than count 1-byte unpacks
+        self._seek_value(self.count)
+        data = self._fh.read(self.count)
+        if len(data) != self.count:
+            raise IOError('Short read')
+        if data[-1:] != b'\0':
+            raise ValueError('String not null-terminated')
+        return data[:-1]
+
+    def _value_numeric(self):
+        # Read numeric arrays into an array.array instead of unpacking a
+        # Python object per item
+        typecode = TYPE_TYPECODES.get(self.type)
+        if typecode is None:
+            raise ValueError('Unsupported type')
+        size = self.count * struct.calcsize(typecode)
+        self._seek_value(size)
+        buf = self._fh.read(size)
+        if len(buf) != size:
+            raise IOError('Short read')
+        items = array.array(typecode)
+        items.frombytes(buf)
+        if self._fh._fmt_prefix != NATIVE_PREFIX:
+            items.byteswap()
+        return items
 
 
 class MrxsFile(object):
@@ -251,12 +568,13 @@ class MrxsFile(object):
         self._dat.optionxform = str
         try:
             with open(self._slidedatfile, 'rb') as fh:
-                self._have_bom = (fh.read(len(UTF8_BOM)) == UTF8_BOM)
-                if not self._have_bom:
-                    fh.seek(0)
-                self._dat.readfp(fh)
+                data = fh.read()
         except IOError:
             raise UnrecognizedFile
+        self._have_bom = data.startswith(UTF8_BOM)
+        if self._have_bom:
+            data = data[len(UTF8_BOM):]
+        self._dat.read_string(data.decode('utf-8'))
 
         # Get file paths
         self._indexfile = os.path.join(dirname,
@@ -282,53 +600,46 @@ class MrxsFile(object):
                 self._level_list.append(level)
 
     @classmethod
-    def _read_int32(cls, f):
-        buf = f.read(4)
-        if len(buf) != 4:
+    def _read_int32(cls, mm, offset):
+        try:
+            return MRXS_INT32.unpack_from(mm, offset)[0]
+        except struct.error:
             raise IOError('Short read')
-        return struct.unpack('<i', buf)[0]
 
     @classmethod
-    def _assert_int32(cls, f, value):
-        v = cls._read_int32(f)
+    def _assert_int32(cls, mm, offset, value):
+        v = cls._read_int32(mm, offset)
         if v != value:
             raise ValueError('%d != %d' % (v, value))
 
-    def _get_data_location(self, record):
-        with open(self._indexfile, 'rb') as fh:
-            fh.seek(MRXS_NONHIER_ROOT_OFFSET)
-            # seek to record
-            table_base = self._read_int32(fh)
-            fh.seek(table_base + record * 4)
-            # seek to list head
-            list_head = self._read_int32(fh)
-            fh.seek(list_head)
-            # seek to data page
-            self._assert_int32(fh, 0)
-            page = self._read_int32(fh)
-            fh.seek(page)
-            # check pagesize
-            self._assert_int32(fh, 1)
-            # read rest of prologue
-            self._read_int32(fh)
-            self._assert_int32(fh, 0)
-            self._assert_int32(fh, 0)
-            # read values
-            position = self._read_int32(fh)
-            size = self._read_int32(fh)
-            fileno = self._read_int32(fh)
-            return (self._datafiles[fileno], position, size)
-
-    def _zero_record(self, record):
-        path, offset, length = self._get_data_location(record)
+    def _get_data_location(self, mm, record):
+        # find the record in the table
+        table_base = self._read_int32(mm, MRXS_NONHIER_ROOT_OFFSET)
+        # find the list head
+        list_head = self._read_int32(mm, table_base + record * 4)
+        # find the data page
+        self._assert_int32(mm, list_head, 0)
+        page = self._read_int32(mm, list_head + 4)
+        # check pagesize, skip rest of prologue
+        self._assert_int32(mm, page, 1)
+        self._assert_int32(mm, page + 8, 0)
+        self._assert_int32(mm, page + 12, 0)
+        # read values
+        position = self._read_int32(mm, page + 16)
+        size = self._read_int32(mm, page + 20)
+        fileno = self._read_int32(mm, page + 24)
+        return (self._datafiles[fileno], position, size)
+
+    def _zero_record(self, location):
+        path, offset, length = location
         with open(path, 'r+b') as fh:
             fh.seek(0, 2)
             do_truncate = (fh.tell() == offset + length)
             if DEBUG:
                 if do_truncate:
-                    print 'Truncating', path, 'to', offset
+                    print('Truncating', path, 'to', offset)
                 else:
-                    print 'Zeroing', path, 'at', offset, 'for', length
+                    print('Zeroing', path, 'at', offset, 'for', length)
             fh.seek(offset)
             buf = fh.read(len(JPEG_SOI))
             if buf != JPEG_SOI:
@@ -336,89 +647,99 @@ class MrxsFile(object):
             if do_truncate:
                 fh.truncate(offset)
             else:
-                fh.seek(offset)
-                fh.write('\0' * length)
+                _zero_file_range(fh, offset, length)
 
-    def _delete_index_record(self, record):
+    def _delete_index_record(self, mm, record):
         if DEBUG:
-            print 'Deleting record', record
-        with open(self._indexfile, 'r+b') as fh:
-            entries_to_move = len(self._level_list) - record - 1
-            if entries_to_move == 0:
-                return
-            # get base of table
-            fh.seek(MRXS_NONHIER_ROOT_OFFSET)
-            table_base = self._read_int32(fh)
-            # read tail of table
-            fh.seek(table_base + (record + 1) * 4)
-            buf = fh.read(entries_to_move * 4)
-            if len(buf) != entries_to_move * 4:
-                raise IOError('Short read')
-            # overwrite the target record
-            fh.seek(table_base + record * 4)
-            fh.write(buf)
-
-    def _hier_keys_for_level(self, level):
-        ret = []
+            print('Deleting record', record)
+        entries_to_move = len(self._level_list) - record - 1
+        if entries_to_move == 0:
+            return
+        # get base of table
+        table_base = self._read_int32(mm, MRXS_NONHIER_ROOT_OFFSET)
+        # move the tail of the table over the target record
+        src = table_base + (record + 1) * 4
+        dst = table_base + record * 4
+        count = entries_to_move * 4
+        if src + count > len(mm):
+            raise IOError('Short read')
+        mm[dst:dst + count] = mm[src:src + count]
+
+    def _hier_keys_by_prefix(self):
+        # Bucket the [HIERARCHICAL] keys by level prefix in one pass, so
+        # delete_level doesn't rescan the whole section for every level
+        # it touches
+        keys = {}
         for k, _ in self._dat.items(MRXS_HIERARCHICAL):
-            if k == level.key_prefix or k.startswith(level.key_prefix + '_'):
-                ret.append(k)
-        return ret
+            m = MRXS_NONHIER_VAL_KEY.match(k)
+            if m:
+                keys.setdefault(m.group(1), []).append(k)
+        return keys
 
     def _rename_section(self, old, new):
         if self._dat.has_section(old):
             if DEBUG:
-                print '[%s] -> [%s]' % (old, new)
+                print('[%s] -> [%s]' % (old, new))
             self._dat.add_section(new)
             for k, v in self._dat.items(old):
                 self._dat.set(new, k, v)
             self._dat.remove_section(old)
         elif DEBUG:
-            print '[%s] does not exist' % old
+            print('[%s] does not exist' % old)
 
     def _delete_section(self, section):
         if DEBUG:
-            print 'Deleting [%s]' % section
+            print('Deleting [%s]' % section)
         self._dat.remove_section(section)
 
     def _set_key(self, section, key, value):
         if DEBUG:
             prev = self._dat.get(section, key)
-            print '[%s] %s: %s -> %s' % (section, key, prev, value)
+            print('[%s] %s: %s -> %s' % (section, key, prev, value))
         self._dat.set(section, key, value)
 
     def _rename_key(self, section, old, new):
         if DEBUG:
-            print '[%s] %s -> %s' % (section, old, new)
+            print('[%s] %s -> %s' % (section, old, new))
         v = self._dat.get(section, old)
         self._dat.remove_option(section, old)
         self._dat.set(section, new, v)
 
     def _delete_key(self, section, key):
         if DEBUG:
-            print 'Deleting [%s] %s' % (section, key)
+            print('Deleting [%s] %s' % (section, key))
         self._dat.remove_option(section, key)
 
     def _write(self):
-        buf = StringIO()
-        self._dat.write(buf)
+        # Stream the config straight to the file, letting TextIOWrapper
+        # encode and emit CRLF as it goes, instead of building the whole
+        # document in a StringIO and rewriting its line endings
         with open(self._slidedatfile, 'wb') as fh:
             if self._have_bom:
                 fh.write(UTF8_BOM)
-            fh.write(buf.getvalue().replace('\n', '\r\n'))
+            wrapper = io.TextIOWrapper(fh, encoding='utf-8', newline='\r\n')
+            self._dat.write(wrapper)
+            wrapper.flush()
+            wrapper.detach()
 
     def delete_level(self, layer_name, level_name):
         level = self._levels[(layer_name, level_name)]
         record = level.record
 
-        # Zero image data
-        self._zero_record(record)
-
-        # Delete pointer from nonhier table in index
-        self._delete_index_record(record)
+        # Zero image data and delete the pointer from the nonhier table,
+        # mapping the index file once and parsing it in memory
+        with open(self._indexfile, 'r+b') as fh:
+            mm = mmap.mmap(fh.fileno(), 0)
+            try:
+                location = self._get_data_location(mm, record)
+                self._zero_record(location)
+                self._delete_index_record(mm, record)
+            finally:
+                mm.close()
 
         # Remove slidedat keys
-        for k in self._hier_keys_for_level(level):
+        keys_by_prefix = self._hier_keys_by_prefix()
+        for k in keys_by_prefix.get(level.key_prefix, ()):
             self._delete_key(MRXS_HIERARCHICAL, k)
 
         # Remove slidedat section
@@ -429,7 +750,7 @@ class MrxsFile(object):
         for cur_level in self._level_list[record + 1:]:
             if cur_level.layer_id != prev_level.layer_id:
                 break
-            for k in self._hier_keys_for_level(cur_level):
+            for k in keys_by_prefix.get(cur_level.key_prefix, ()):
                 new_k = k.replace(cur_level.key_prefix,
                         prev_level.key_prefix, 1)
                 self._rename_key(MRXS_HIERARCHICAL, k, new_k)
@@ -441,13 +762,28 @@ class MrxsFile(object):
         # Update level count within layer
         count_k = 'NONHIER_%d_COUNT' % level.layer_id
         count_v = self._dat.getint(MRXS_HIERARCHICAL, count_k)
-        self._set_key(MRXS_HIERARCHICAL, count_k, count_v - 1)
+        self._set_key(MRXS_HIERARCHICAL, count_k, str(count_v - 1))
 
         # Write slidedat
         self._write()
 
-        # Refresh metadata
-        self._make_levels()
+        # Update level metadata in place rather than reparsing slidedat.
+        # Subsequent levels in the layer inherit their predecessor's id,
+        # key prefix and section, mirroring the renames above.
+        self._level_list.pop(record)
+        del self._levels[(layer_name, level_name)]
+        prev_attrs = (level.id, level.key_prefix, level.section_key,
+                level.section)
+        for number, cur_level in enumerate(self._level_list[record:], record):
+            cur_level.record = number
+            if prev_attrs is not None and cur_level.layer_id == level.layer_id:
+                cur_attrs = (cur_level.id, cur_level.key_prefix,
+                        cur_level.section_key, cur_level.section)
+                (cur_level.id, cur_level.key_prefix, cur_level.section_key,
+                        cur_level.section) = prev_attrs
+                prev_attrs = cur_attrs
+            else:
+                prev_attrs = None
 
 
 class MrxsNonHierLevel(object):
@@ -465,7 +801,7 @@ class MrxsNonHierLevel(object):
 
 def accept(filename, format):
     if DEBUG:
-        print filename + ':', format
+        print(filename + ':', format)
 
 
 def do_aperio_svs(filename):
@@ -473,16 +809,21 @@ def do_aperio_svs(filename):
         # Check for SVS file
         try:
             desc0 = fh.directories[0].entries[IMAGE_DESCRIPTION].value()
-            if not desc0.startswith('Aperio'):
+            if not desc0.startswith(b'Aperio'):
                 raise UnrecognizedFile
         except KeyError:
             raise UnrecognizedFile
         accept(filename, 'SVS')
 
-        # Find and delete label
-        for directory in fh.directories:
-            lines = directory.entries[IMAGE_DESCRIPTION].value().splitlines()
-            if len(lines) >= 2 and lines[1].startswith('label '):
+        # Find and delete label, reusing the already-read description of
+        # the first directory
+        for number, directory in enumerate(fh.directories):
+            if number == 0:
+                desc = desc0
+            else:
+                desc = directory.entries[IMAGE_DESCRIPTION].value()
+            lines = desc.splitlines()
+            if len(lines) >= 2 and lines[1].startswith(b'label '):
                 directory.delete(expected_prefix=LZW_CLEARCODE)
                 break
         else:
@@ -519,6 +860,24 @@ format_handlers = [
     do_3dhistech_mrxs,
 ]
 
+TIFF_MAGICS = (b'II\x2a\x00', b'MM\x00\x2a', b'II\x2b\x00', b'MM\x00\x2b')
+
+
+def select_handlers(filename):
+    # Narrow the handler list by extension and magic number so that most
+    # files are only opened by handlers that can plausibly match.  On any
+    # surprise, fall back to trying everything.
+    if os.path.splitext(filename)[1] == '.mrxs':
+        return [do_3dhistech_mrxs]
+    try:
+        with open(filename, 'rb') as fh:
+            magic = fh.read(4)
+    except IOError:
+        return format_handlers
+    if magic in TIFF_MAGICS:
+        return [do_aperio_svs, do_hamamatsu_ndpi]
+    return format_handlers
+
 
 def _main():
     global DEBUG
@@ -543,7 +902,7 @@ def _main():
     exit_code = 0
     for filename in filenames:
         try:
-            for handler in format_handlers:
+            for handler in select_handlers(filename):
                 try:
                     handler(filename)
                     break
@@ -551,10 +910,10 @@ def _main():
                     pass
             else:
                 raise IOError('Unrecognized file type')
-        except Exception, e:
+        except Exception as e:
             if DEBUG:
                 raise
-            print >>sys.stderr, '%s: %s' % (filename, str(e))
+            print('%s: %s' % (filename, str(e)), file=sys.stderr)
             exit_code = 1
     sys.exit(exit_code)
 